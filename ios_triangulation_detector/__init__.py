@@ -2,17 +2,60 @@
 # Checks full iOS filesystem images for traces of compromise by Operation Triangulation
 # Based on Kaspersky's triangle_check tool (© 2023 AO Kaspersky Lab. All Rights Reserved)
 
+import concurrent.futures
+import contextlib
 import sqlite3
 import plistlib
+import operator
 import os
 import os.path
+import shutil
 import stat
+import tempfile
+import urllib.parse
+from collections import defaultdict
 from datetime import datetime, timezone
 
+# SMS attachment directory, relative to the image root. Attachment events are
+# recorded with this prefix and tagged when recorded, so the heuristics never
+# have to search paths for it
+SMS_ATTACHMENTS_PATH = 'private/var/mobile/Library/SMS/Attachments'
+
+# Need to adjust Apple's timestamp (2001 epoch) to Unix timestamp
+COCOA_DELTA = 978307200.0
+
+# Known suspicious processes
+PROCESS_IOCS_EXACT = frozenset({'BackupAgent'})
+PROCESS_IOCS_IMPLICIT = frozenset({'nehelper', 'com.apple.WebKit.WebContent', 'powerd/com.apple.datausage.diagnostics', 'lockdownd/com.apple.datausage.security'})
+PROCESS_IOCS_ALL = PROCESS_IOCS_EXACT | PROCESS_IOCS_IMPLICIT
+
+# Known suspicious location bundles
+LOCATION_CLIENT_IOCS = frozenset({
+    'com.apple.locationd.bundle-/System/Library/LocationBundles/IonosphereHarvest.bundle',
+    'com.apple.locationd.bundle-/System/Library/LocationBundles/WRMLinkSelection.bundle'
+})
+
+# Human-readable names of the timeline events shown in heuristic detections
+EVENT_DESCRIPTIONS = {
+    'M': 'file modification',
+    'C': 'file attribute change',
+    'B': 'file birth',
+    'LocationTimeStopped': 'location service stopped'
+}
+
+# Timeline events that record traffic by a suspicious process
+NET_EVENT_TYPES = frozenset({'NetTimestamp', 'NetUsage', 'NetFirst', 'NetTimestamp2'})
+
+# Events every SMS attachment directory in a window needs: modification (M) and attribute change (C)
+SMS_REQUIRED_EVENTS = frozenset({'M', 'C'})
+
 # Main class that handles the filesystem image scanning
 class IOSFilesystemChecker:
+    # Fixed attribute set; root_path and paths are only assigned by scan_filesystem
+    __slots__ = ('timeline', 'detections', 'root_path', 'paths')
+
     def __init__(self):
-        self.timeline = {}
+        self.timeline = []
         self.detections = {}
 
     def append_map(self, timestamp, item, map):
@@ -21,45 +64,45 @@ class IOSFilesystemChecker:
         map[timestamp].append(item)
 
     def append_timeline(self, timestamp, item):
-        self.append_map(timestamp, item, self.timeline)
+        self.timeline.append((timestamp, item))
 
     def append_detection(self, timestamp, item):
         self.append_map(timestamp, item, self.detections)
 
     def run_heuristics(self, event_window):
         """Analyzes a window of filesystem events for suspicious patterns"""
-        sms_attachment_directories = {}
+        sms_attachment_directories = defaultdict(set)
         timestamp_start = event_window[0][0]
 
         event_classes = set()
+        add_event_class = event_classes.add
 
-        for (event_timestamp, event) in event_window:
+        for event_timestamp, event in event_window:
             event_type = event[0]
             if event_type in ['M', 'C', 'B']:  # filesystem events
-                path = event[1]
-                if 'Library/SMS/Attachments/' in path:
+                # Filesystem events are (type, rel_path, depth, is_attachment_dir),
+                # parsed once when the event was recorded
+                _, path, depth, is_attachment_dir = event
+                if is_attachment_dir:
                     # The paths we want to detect are like:
                     # /private/var/mobile/Library/SMS/Attachments/ff/15
                     # /private/var/mobile/Library/SMS/Attachments/76/06
-                    path_parts = path.split('Library/SMS/Attachments/')[1].split('/')
                     
                     # Check path depth to ensure we're looking at directories, not actual files
-                    if len(path_parts) <= 2:
-                        sms_attachment_directories[path] = sms_attachment_directories.get(path, {})
-                        sms_attachment_directories[path][event_type] = True
+                    if depth <= 2:
+                        sms_attachment_directories[path].add(event_type)
                     else:
                         return  # False positive - actual attachment file
                 else:  # other suspicious locations
-                    event_classes.add('file')
-            elif event_type in ['NetTimestamp', 'NetUsage', 'NetFirst', 'NetTimestamp2']:
-                event_classes.add('net')
+                    add_event_class('file')
+            elif event_type in NET_EVENT_TYPES:
+                add_event_class('net')
             elif event_type == 'LocationTimeStopped':
-                event_classes.add('location')
+                add_event_class('location')
 
         # Check that directories have both modification (M) and attribute change (C) events
-        for k, v in sms_attachment_directories.items():
-            if (not 'M' in v) or (not 'C' in v):
-                return False
+        if any(not SMS_REQUIRED_EVENTS.issubset(v) for v in sms_attachment_directories.values()):
+            return False
             
         if (len(sms_attachment_directories) > 0):
             event_classes.add('sms')
@@ -71,79 +114,104 @@ class IOSFilesystemChecker:
 
     def scan_filesystem(self, root_path):
         """Scans a full iOS filesystem image for signs of compromise"""
-        self.root_path = root_path
+        # Normalize once so the paths below can be built by plain concatenation
+        root = root_path.rstrip('/')
+        self.root_path = root
         
         # Path mappings for key files we need to analyze
         self.paths = {
-            'sms_attachments_dir': os.path.join(root_path, 'private/var/mobile/Library/SMS/Attachments'),
-            'locationd_plist': os.path.join(root_path, 'private/var/mobile/Library/Preferences/com.apple.locationd.StatusBarIconManager.plist'),
-            'facetime_plist': os.path.join(root_path, 'private/var/mobile/Library/Preferences/com.apple.imservice.ids.FaceTime.plist'),
-            'imageio_plist': os.path.join(root_path, 'private/var/mobile/Library/Preferences/com.apple.ImageIO.plist'),
-            'osanalytics_plist': os.path.join(root_path, 'private/var/mobile/Library/Preferences/com.apple.osanalytics.addaily.plist'),
-            'datausage_db': os.path.join(root_path, 'private/var/mobile/Library/Databases/DataUsage.sqlite'),
-            'locationd_clients': os.path.join(root_path, 'private/var/mobile/Library/Caches/locationd/clients.plist')
+            'sms_attachments_dir': root + '/' + SMS_ATTACHMENTS_PATH,
+            'locationd_plist': root + '/private/var/mobile/Library/Preferences/com.apple.locationd.StatusBarIconManager.plist',
+            'facetime_plist': root + '/private/var/mobile/Library/Preferences/com.apple.imservice.ids.FaceTime.plist',
+            'imageio_plist': root + '/private/var/mobile/Library/Preferences/com.apple.ImageIO.plist',
+            'osanalytics_plist': root + '/private/var/mobile/Library/Preferences/com.apple.osanalytics.addaily.plist',
+            'datausage_db': root + '/private/var/mobile/Library/Databases/DataUsage.sqlite',
+            'locationd_clients': root + '/private/var/mobile/Library/Caches/locationd/clients.plist'
         }
         
         # Verify the path exists and is a directory
         if not os.path.isdir(self.paths['sms_attachments_dir']):
             raise FileNotFoundError(f"SMS attachments directory not found at {self.paths['sms_attachments_dir']}")
         
-        # Start gathering file metadata for key files and directories
-        self._check_sms_attachments()
-        self._check_system_plists()
-        self._check_analytics_data()
+        # Start gathering file metadata for key files and directories. The checks
+        # read disjoint files and are I/O bound, so they run in parallel. Each one
+        # returns its own events (only _check_analytics_data records detections),
+        # and they are added to the timeline in this fixed order.
+        checks = [self._check_sms_attachments, self._check_system_plists, self._check_analytics_data]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(checks)) as executor:
+            for check_timeline in executor.map(lambda check: check(), checks):
+                self.timeline.extend(check_timeline)
         
-        # Analyze the timeline for suspicious patterns
-        expanded_timeline = []
-        for k in sorted(self.timeline):
-            for item in self.timeline[k]:
-                expanded_timeline.append((k, item))
+        # Analyze the timeline for suspicious patterns. The sort is stable, so
+        # events sharing a timestamp keep the order they were recorded in.
+        self.timeline.sort(key=operator.itemgetter(0))
+        expanded_timeline = self.timeline
 
-        # Use a sliding window to look for suspicious event combinations
+        # Use a sliding window to look for suspicious event combinations.
+        # The window end only ever moves forward, so the sweep is linear.
         events_max = 10
         time_delta_max = 60*5  # 5 minutes window
-        for i in range(len(expanded_timeline)-events_max):
-            timestamp_start = expanded_timeline[i][0]
-            event_window = expanded_timeline[i:i+events_max]
-            for j in range(len(event_window)):
-                timestamp_item = event_window[j][0]
-                if timestamp_item - timestamp_start > time_delta_max:
-                    event_window = event_window[:j]
-                    break
-
-            self.run_heuristics(event_window)
+        timestamps = [timestamp for timestamp, _ in expanded_timeline]
+        timestamps_count = len(timestamps)
+        run_heuristics = self.run_heuristics  # bound once, not looked up per window
+        right = 0
+        for left in range(timestamps_count):
+            while right < timestamps_count and timestamps[right] - timestamps[left] <= time_delta_max:
+                right += 1
+            run_heuristics(expanded_timeline[left:min(right, left + events_max)])
 
         return self.detections
     
     def _check_sms_attachments(self):
         """Check SMS attachment directories for suspicious patterns"""
-        # Walk through all the SMS attachment directories
-        for root, dirs, files in os.walk(self.paths['sms_attachments_dir']):
-            rel_path = root.replace(self.root_path, '').lstrip('/')
-            if rel_path.count('/') >= 3:  # Only want to check the directory structure, not actual files
-                continue
-                
-            # Get file stats
-            try:
-                stats = os.stat(root)
-                mtime = stats.st_mtime
-                ctime = stats.st_ctime
-                birthtime = stats.st_birthtime if hasattr(stats, 'st_birthtime') else ctime
-                
-                # Record these events in our timeline
-                self.append_timeline(mtime, ('M', rel_path))
-                self.append_timeline(ctime, ('C', rel_path))
-                self.append_timeline(birthtime, ('B', rel_path))
-                
-                # Check if directory is empty and record that
-                if len(os.listdir(root)) == 0 and rel_path.count('/') >= 2:
-                    # Empty attachment directory is suspicious
-                    print(f"Empty attachment directory found: {rel_path} modified at {datetime.fromtimestamp(mtime)}")
-            except Exception as e:
-                print(f"Error accessing {rel_path}: {str(e)}")
+        timeline = []
+        attach_root = self.paths['sms_attachments_dir']
+        try:
+            self._walk_attachments(attach_root, SMS_ATTACHMENTS_PATH, timeline)
+        except Exception as e:
+            print(f"Error accessing {attach_root}: {str(e)}")
+        return timeline
+
+    def _walk_attachments(self, root, rel_root, timeline, depth=0):
+        """Record timestamps of the attachment directories below root in timeline.
+
+        The paths we want are like Library/SMS/Attachments/ff/15, so only the
+        first two directory levels are visited and the actual attachment files
+        below them are never touched. DirEntry caches the readdir type, so each
+        directory costs a single stat() call.
+        """
+        with os.scandir(root) as it:
+            for entry in it:
+                rel_path = rel_root + '/' + entry.name
+                try:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+
+                    # Get file stats
+                    stats = entry.stat(follow_symlinks=False)
+                    mtime = stats.st_mtime
+                    ctime = stats.st_ctime
+                    birthtime = stats.st_birthtime if hasattr(stats, 'st_birthtime') else ctime
+
+                    # Record these events in our timeline
+                    timeline.append((mtime, ('M', rel_path, depth + 1, True)))
+                    timeline.append((ctime, ('C', rel_path, depth + 1, True)))
+                    timeline.append((birthtime, ('B', rel_path, depth + 1, True)))
+
+                    if depth < 1:
+                        self._walk_attachments(entry.path, rel_path, timeline, depth + 1)
+                    else:
+                        # Check if directory is empty and record that
+                        with os.scandir(entry.path) as children:
+                            if next(children, None) is None:
+                                # Empty attachment directory is suspicious
+                                print(f"Empty attachment directory found: {rel_path} modified at {datetime.fromtimestamp(mtime)}")
+                except Exception as e:
+                    print(f"Error accessing {rel_path}: {str(e)}")
     
     def _check_system_plists(self):
         """Check system preference files that are often modified during exploitation"""
+        timeline = []
         # List of important plist files to check
         plist_files = [
             ('locationd_plist', 'com.apple.locationd.StatusBarIconManager.plist'),
@@ -160,17 +228,19 @@ class IOSFilesystemChecker:
                     ctime = stats.st_ctime
                     birthtime = stats.st_birthtime if hasattr(stats, 'st_birthtime') else ctime
                     
-                    rel_path = path.replace(self.root_path, '').lstrip('/')
+                    rel_path = path[len(self.root_path):].lstrip('/')
                     rel_path = '/'.join(rel_path.split('/')[-2:])  # Just get Library/Preferences/file.plist
                     
-                    self.append_timeline(mtime, ('M', rel_path))
-                    self.append_timeline(ctime, ('C', rel_path))
-                    self.append_timeline(birthtime, ('B', rel_path))
+                    timeline.append((mtime, ('M', rel_path, 0, False)))
+                    timeline.append((ctime, ('C', rel_path, 0, False)))
+                    timeline.append((birthtime, ('B', rel_path, 0, False)))
                 except Exception as e:
                     print(f"Error accessing {path}: {str(e)}")
+        return timeline
     
     def _check_analytics_data(self):
         """Check analytics data for suspicious network activity"""
+        timeline = []
         # Check OS Analytics plist
         if os.path.exists(self.paths['osanalytics_plist']):
             try:
@@ -180,49 +250,30 @@ class IOSFilesystemChecker:
                 if 'netUsageBaseline' in osanalytics:
                     baseline = osanalytics['netUsageBaseline']
                     
-                    # Known suspicious processes
-                    process_IOCs_exact = ['BackupAgent']
-                    process_IOCs_implicit = ['nehelper', 'com.apple.WebKit.WebContent', 'powerd/com.apple.datausage.diagnostics', 'lockdownd/com.apple.datausage.security']
-                    
-                    for package in baseline:
-                        if package in process_IOCs_exact:
-                            self.append_detection(baseline[package][0].replace(tzinfo=timezone.utc).timestamp(), ('exact', 'NetUsage', package))
-                        if (package in process_IOCs_implicit) or (package in process_IOCs_exact):
-                            self.append_timeline(baseline[package][0].replace(tzinfo=timezone.utc).timestamp(), ('NetUsage', package))
+                    # Only look up the few IOCs instead of scanning every process,
+                    # in a fixed order so equal timestamps stay reproducible
+                    for package in sorted(PROCESS_IOCS_ALL & baseline.keys()):
+                        timestamp = baseline[package][0].replace(tzinfo=timezone.utc).timestamp()
+                        if package in PROCESS_IOCS_EXACT:
+                            self.append_detection(timestamp, ('exact', 'NetUsage', package))
+                        timeline.append((timestamp, ('NetUsage', package)))
             except Exception as e:
                 print(f"Error analyzing OS analytics: {str(e)}")
         
         # Check DataUsage database
         if os.path.exists(self.paths['datausage_db']):
             try:
-                datausage = sqlite3.connect(self.paths['datausage_db'])
-                data_cur = datausage.cursor()
-                
-                # Need to adjust Apple's timestamp (2001 epoch) to Unix timestamp
-                cocoa_delta = 978307200.0
-                
-                # Known suspicious processes
-                process_IOCs_exact = ['BackupAgent']
-                process_IOCs_implicit = ['nehelper', 'com.apple.WebKit.WebContent', 'powerd/com.apple.datausage.diagnostics', 'lockdownd/com.apple.datausage.security']
-                
-                # Query process and usage data
-                for first_timestamp, proc_timestamp, procname, bundlename, pk, timestamp in data_cur.execute(
-                    'SELECT ZPROCESS.ZFIRSTTIMESTAMP,ZPROCESS.ZTIMESTAMP,ZPROCESS.ZPROCNAME,ZPROCESS.ZBUNDLENAME,ZPROCESS.Z_PK,'
-                    'ZLIVEUSAGE.ZTIMESTAMP FROM ZLIVEUSAGE LEFT JOIN ZPROCESS ON ZLIVEUSAGE.ZHASPROCESS = ZPROCESS.Z_PK UNION '
-                    'SELECT ZFIRSTTIMESTAMP, ZTIMESTAMP, ZPROCNAME, ZBUNDLENAME, Z_PK, NULL FROM ZPROCESS WHERE Z_PK NOT IN (SELECT ZHASPROCESS FROM ZLIVEUSAGE)'):
-                    
-                    if procname in process_IOCs_exact:
-                        self.append_detection(cocoa_delta + first_timestamp, ('exact', 'NetFirst', procname))
-                        self.append_detection(cocoa_delta + proc_timestamp, ('exact', 'NetTimestamp', procname))
-                        if timestamp is not None:
-                            self.append_detection(cocoa_delta + timestamp, ('exact', 'NetTimestamp2', procname))
-                    elif (procname in process_IOCs_implicit):
-                        self.append_timeline(cocoa_delta + first_timestamp, ('NetFirst', procname))
-                        self.append_timeline(cocoa_delta + proc_timestamp, ('NetTimestamp', procname))
-                        if timestamp is not None:
-                            self.append_timeline(cocoa_delta + timestamp, ('NetTimestamp2', procname))
-                
-                datausage.close()
+                try:
+                    self._read_datausage(self.paths['datausage_db'], timeline)
+                except sqlite3.OperationalError:
+                    # A read-only mount can keep SQLite from creating the -shm file it needs to
+                    # read the WAL, so query a copy of the database together with its -wal
+                    with tempfile.TemporaryDirectory() as tmp_dir:
+                        db_copy = os.path.join(tmp_dir, 'DataUsage.sqlite')
+                        for suffix in ['', '-wal']:
+                            if os.path.exists(self.paths['datausage_db'] + suffix):
+                                shutil.copy2(self.paths['datausage_db'] + suffix, db_copy + suffix)
+                        self._read_datausage(db_copy, timeline)
             except Exception as e:
                 print(f"Error analyzing data usage: {str(e)}")
         
@@ -232,38 +283,59 @@ class IOSFilesystemChecker:
                 with open(self.paths['locationd_clients'], 'rb') as f:
                     locationd_clients = plistlib.load(f)
                 
-                location_client_IOCs = [
-                    'com.apple.locationd.bundle-/System/Library/LocationBundles/IonosphereHarvest.bundle',
-                    'com.apple.locationd.bundle-/System/Library/LocationBundles/WRMLinkSelection.bundle'
-                ]
-                
-                cocoa_delta = 978307200.0
-                
-                for package in locationd_clients:
-                    item = locationd_clients[package]
-                    if (package in location_client_IOCs) and ('LocationTimeStopped' in item):
-                        self.append_timeline(cocoa_delta + item['LocationTimeStopped'], ('LocationTimeStopped', package))
+                for package in sorted(LOCATION_CLIENT_IOCS & locationd_clients.keys()):
+                    location_time_stopped = locationd_clients[package].get('LocationTimeStopped')
+                    if location_time_stopped is not None:
+                        timeline.append((COCOA_DELTA + location_time_stopped, ('LocationTimeStopped', package)))
             except Exception as e:
                 print(f"Error analyzing location clients: {str(e)}")
+        return timeline
+    
+    def _read_datausage(self, db_path, timeline):
+        """Query DataUsage.sqlite for traffic by suspicious processes, adding events to timeline"""
+        # Open read-only so the database and its -wal are never modified (SQLite may
+        # still create the -shm index next to them). Not immutable: iOS keeps this
+        # database in WAL mode, and rows that were never checkpointed are only
+        # visible when SQLite reads the -wal file
+        datausage = sqlite3.connect(f"file:{urllib.parse.quote(db_path)}?mode=ro", uri=True)
+        with contextlib.closing(datausage):
+            data_cur = datausage.cursor()
+            iocs = tuple(PROCESS_IOCS_ALL)
+            placeholders = ','.join('?' * len(iocs))
+        
+            # Query process and usage data, letting SQLite drop the unrelated processes
+            data_cur.arraysize = 1000
+            data_cur.execute(
+                'SELECT ZPROCESS.ZFIRSTTIMESTAMP,ZPROCESS.ZTIMESTAMP,ZPROCESS.ZPROCNAME,ZPROCESS.ZBUNDLENAME,ZPROCESS.Z_PK,'
+                'ZLIVEUSAGE.ZTIMESTAMP FROM ZLIVEUSAGE LEFT JOIN ZPROCESS ON ZLIVEUSAGE.ZHASPROCESS = ZPROCESS.Z_PK '
+                f'WHERE ZPROCESS.ZPROCNAME IN ({placeholders}) UNION '
+                'SELECT ZFIRSTTIMESTAMP, ZTIMESTAMP, ZPROCNAME, ZBUNDLENAME, Z_PK, NULL FROM ZPROCESS WHERE Z_PK NOT IN (SELECT ZHASPROCESS FROM ZLIVEUSAGE) '
+                f'AND ZPROCNAME IN ({placeholders})', iocs * 2)
+            for rows in iter(data_cur.fetchmany, []):
+                for first_timestamp, proc_timestamp, procname, bundlename, pk, timestamp in rows:
+                    if procname in PROCESS_IOCS_EXACT:
+                        self.append_detection(COCOA_DELTA + first_timestamp, ('exact', 'NetFirst', procname))
+                        self.append_detection(COCOA_DELTA + proc_timestamp, ('exact', 'NetTimestamp', procname))
+                        if timestamp is not None:
+                            self.append_detection(COCOA_DELTA + timestamp, ('exact', 'NetTimestamp2', procname))
+                    elif (procname in PROCESS_IOCS_IMPLICIT):
+                        timeline.append((COCOA_DELTA + first_timestamp, ('NetFirst', procname)))
+                        timeline.append((COCOA_DELTA + proc_timestamp, ('NetTimestamp', procname)))
+                        if timestamp is not None:
+                            timeline.append((COCOA_DELTA + timestamp, ('NetTimestamp2', procname)))
     
     def detection_to_string(self, detection):
         """Convert a detection to a human-readable string"""
         if detection[0] == 'exact':
             return f'Exact match by {detection[1]} : {detection[2]}'
         elif detection[0] == 'heuristics':
-            result = f'Suspicious combination of events: '
+            parts = ['Suspicious combination of events: ']
             for timestamp, event in detection[1]:
                 event_type = event[0]
-                if event_type == 'M':
-                    result += f'\n * file modification: {event[1]}'
-                elif event_type == 'C':
-                    result += f'\n * file attribute change: {event[1]}'
-                elif event_type == 'B':
-                    result += f'\n * file birth: {event[1]}'
-                elif event_type == 'LocationTimeStopped':
-                    result += f'\n * location service stopped: {event[1]}'
-                elif event_type in ['NetTimestamp', 'NetUsage', 'NetFirst', 'NetTimestamp2']:
-                    result += f'\n * traffic by process {event[1]}'
+                if event_type in EVENT_DESCRIPTIONS:
+                    parts.append(f' * {EVENT_DESCRIPTIONS[event_type]}: {event[1]}')
+                elif event_type in NET_EVENT_TYPES:
+                    parts.append(f' * traffic by process {event[1]}')
                 else:
                     raise RuntimeError(f'Unknown detection event {event_type}')
-            return result
+            return '\n'.join(parts)
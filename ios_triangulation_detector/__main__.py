@@ -39,16 +39,18 @@ def main():
         return
 
     if len(results) > 0:
-        print(Fore.LIGHTRED_EX + '==== IDENTIFIED TRACES OF COMPROMISE (Operation Triangulation) ====' + Fore.RESET)
+        # Collect the whole report and write it at once instead of one print per line
+        lines = [Fore.LIGHTRED_EX + '==== IDENTIFIED TRACES OF COMPROMISE (Operation Triangulation) ====' + Fore.RESET]
             
         for k in sorted(results):  # k is a UNIX timestamp of detection
+            dt = datetime.fromtimestamp(k, tz=timezone.utc)
             for detection in results[k]:
-                dt = datetime.fromtimestamp(k, tz=timezone.utc)
                 explanation = checker.detection_to_string(detection)
                 if detection[0] == 'exact':
-                    print(f'{dt} ' + Fore.LIGHTRED_EX + 'DETECTED' + Fore.RESET + ' ' + explanation)
+                    lines.append(f'{dt} ' + Fore.LIGHTRED_EX + 'DETECTED' + Fore.RESET + ' ' + explanation)
                 elif detection[0] == 'heuristics':
-                    print(f'{dt} ' + Fore.LIGHTYELLOW_EX + 'SUSPICION' + Fore.RESET + ' ' + explanation)
+                    lines.append(f'{dt} ' + Fore.LIGHTYELLOW_EX + 'SUSPICION' + Fore.RESET + ' ' + explanation)
+        sys.stdout.write('\n'.join(lines) + '\n')
         sys.exit(2)
     else:
         print(Fore.GREEN + 'No traces of compromise were identified' + Fore.RESET)